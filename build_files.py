@@ -1,7 +1,11 @@
+import io
+import os
 import shutil
 import logging
+import tarfile
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from font import FontData, FontFile
 from utils import sanitise_alphanum
@@ -10,50 +14,171 @@ from utils import sanitise_alphanum
 logger = logging.getLogger(__name__)
 
 
+def locate_apk_dir(build_files: Path) -> Path:
+    """
+    Returns the "app-debug" apk dir inside the build files.
+
+    Args:
+        build_files (Path): The path to the build files.
+
+    Returns:
+        Path: The path to the apk dir.
+    """
+    if not build_files.exists():
+        raise Exception(f"Apk build files not found: {build_files}")
+
+    apk_dir = build_files / "app-debug"
+    if not apk_dir.exists():
+        raise Exception(f"Apk dir not found in apk build files: {apk_dir}")
+
+    return apk_dir
+
+
+def snapshot_apk_dir(build_files: Path) -> bytes:
+    """
+    Packs the apk dir from the build files into an in-memory tar archive.
+    The snapshot is built once and extracted for every font, which is a
+    lot cheaper than copying the tree file by file each time.
+
+    Args:
+        build_files (Path): The path to the build files.
+
+    Returns:
+        bytes: Uncompressed tar archive containing the "app-debug" dir.
+    """
+    apk_dir = locate_apk_dir(build_files)
+
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        tar.add(apk_dir, arcname=apk_dir.name)
+    return buffer.getvalue()
+
+
 class BuildContext(TemporaryDirectory):
     """
     This class inherits from `TemporaryDirectory` and provides a temp 
-    directory for building files. It copies the apk files to the temp dir
-    and encapsulates the paths for the apk dir and jar tools. The temp
-    directory is cleaned up on exit.
+    directory for building files. The apk files are hardlinked into the
+    temp dir, except for the files `FontAPK` writes to, which are copied.
+    If hardlinks are not possible (see `can_hardlink`) the apk files 
+    snapshot is extracted instead. It also encapsulates the paths for 
+    the apk dir and jar tools. The temp directory is cleaned up on exit.
 
     Args:
         build_files (Path): The path to the build files.
+        apk_snapshot (bytes): Tar archive of the apk dir, see 
+            `snapshot_apk_dir`. The apk files are hardlinked if None.
 
     Example:
-        with BuildContext(build_files=Path("apk_build_files")) as bc:
+        snapshot = None
+        if not can_hardlink(Path("apk_build_files")):
+            snapshot = snapshot_apk_dir(Path("apk_build_files"))
+        with BuildContext(Path("apk_build_files"), snapshot) as bc:
             # Perform build operations within the temporary directory
             pass
     """
-    def __init__(self, build_files: Path):
+    # Relative to the apk dir, these are modified in place by FontAPK
+    MUTABLE_FILES = frozenset({
+        "assets/font.dat",
+        "assets/font.xml",
+        "assets/font.ttf",
+        "AndroidManifest.xml",
+        "res/values/strings.xml",
+    })
+    APKTOOL_JAR = "apktool.jar"
+    APKSIGNER_JAR = "uber-apk-signer-1.2.1.jar"
+
+    def __init__(self, build_files: Path, apk_snapshot: bytes = None):
         super().__init__()
 
-        if not build_files.exists():
-            raise Exception(f"Apk build files not found: {build_files}")
-        
-        apk_dir = build_files / "app-debug"
-        if not apk_dir.exists():
-            raise Exception(f"Apk dir not found in apk build files: {apk_dir}")
+        apk_dir = locate_apk_dir(build_files)
         
         self.tmp_dir = Path(self.name)
         self.apk_dir = self.tmp_dir / "app-debug"
-        shutil.copytree(apk_dir, self.apk_dir)
 
-        self.apktool_path = build_files / "apktool.jar"
-        self.apksigner_path = build_files / "uber-apk-signer-1.2.1.jar"
+        if apk_snapshot is None:
+            copy_or_link(apk_dir, self.apk_dir, BuildContext.MUTABLE_FILES)
+        else:
+            with tarfile.open(fileobj=io.BytesIO(apk_snapshot)) as tar:
+                tar.extractall(self.tmp_dir)
+
+        self.apktool_path = build_files / BuildContext.APKTOOL_JAR
+        self.apksigner_path = build_files / BuildContext.APKSIGNER_JAR
         
     def __enter__(self):
         return self
 
 
+def can_hardlink(build_files: Path) -> bool:
+    """
+    Checks once whether the apk files can be hardlinked into a temp dir,
+    which fails when the temp dir is on a different filesystem.
+
+    Args:
+        build_files (Path): The path to the build files.
+
+    Returns:
+        bool: True if `BuildContext` can hardlink the apk files.
+    """
+    apk_dir = locate_apk_dir(build_files)
+    src = next((p for p in apk_dir.rglob("*") if p.is_file()), None)
+    if src is None:
+        return False
+
+    with TemporaryDirectory() as tmp_dir:
+        try:
+            os.link(src, Path(tmp_dir) / src.name)
+        except OSError as e:
+            logger.debug(f"Hardlinking apk files not possible: {e}")
+            return False
+    return True
+
+
+def copy_or_link(src: Path, dst: Path, mutable_names: frozenset):
+    """
+    Recreates the src tree at dst. Files are hardlinked, except for the
+    ones listed in mutable_names which are copied, so that writing to 
+    them doesn't modify src.
+
+    Args:
+        src (Path): The source directory.
+        dst (Path): The destination directory, created if missing.
+        mutable_names (frozenset): Posix style paths relative to src.
+
+    Raises:
+        OSError: If a hardlink can't be created.
+    """
+    for dir_path, _, file_names in os.walk(src):
+        rel_dir = Path(dir_path).relative_to(src)
+        (dst / rel_dir).mkdir(parents=True, exist_ok=True)
+
+        for file_name in file_names:
+            rel_path = rel_dir / file_name
+            if rel_path.as_posix() in mutable_names:
+                shutil.copy2(src / rel_path, dst / rel_path)
+            else:
+                os.link(src / rel_path, dst / rel_path)
+
+
 class FontAPK:
     """
     Encapsulates the paths and operations to be performed on the apk
-    directory.
+    directory. The setters only queue their file writes on a small 
+    thread pool so they overlap, call `wait_ready` before building the 
+    apk. Use as a context manager to shut the pool down.
 
     Args:
         apk_base_dir (Path): Path to the apk directory.
+
+    Example:
+        with FontAPK(apk_dir) as font_apk:
+            font_apk.set_font_ttf(font_file)
+            font_apk.set_font_data()
+            font_apk.apply_font_name("Font Name")
+            font_apk.wait_ready()
     """
+    MAX_WORKERS = 4
+    FONT_NAME_PLACEHOLDER = "$$FONT_NAME$$"
+
     def __init__(self, apk_base_dir: Path):
         self.root_path = apk_base_dir
         self.font_data_path = apk_base_dir / "assets/font.dat"
@@ -72,56 +197,99 @@ class FontAPK:
 
         self.compiled_apk_path = None
 
-    def set_font_xml(self, value: str):
-        value = sanitise_alphanum(value)
-        replace_content(
-            self.font_xml_path,
-            "$$FONT_NAME$$",
-            value
+        self._executor = ThreadPoolExecutor(max_workers=FontAPK.MAX_WORKERS)
+        self._pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._executor.shutdown(wait=True)
+
+    def _submit(self, reqs, func, *args):
+        def task():
+            func(*args)
+            for req in reqs:
+                self.compile_reqs[req] = True
+
+        future = self._executor.submit(task)
+        for req in reqs:
+            self._pending[req] = future
+
+    def apply_font_name(self, name: str):
+        """
+        Replaces the font name placeholder in font.xml, the manifest and 
+        strings.xml in a single queued task. font.xml and the manifest 
+        get the sanitised name, strings.xml (the app label) gets it as is.
+
+        Args:
+            name (str): The full font name.
+        """
+        sanitised_name = sanitise_alphanum(name)
+        substitutions = [
+            (self.font_xml_path, sanitised_name),
+            (self.manifest_path, sanitised_name),
+            (self.strings_path, name),
+        ]
+        self._submit(
+            ("font_xml", "manifest", "strings"),
+            self._write_font_name,
+            substitutions
         )
-        self.compile_reqs["font_xml"] = True
+
+    def _write_font_name(self, substitutions):
+        for file_path, value in substitutions:
+            replace_content(file_path, FontAPK.FONT_NAME_PLACEHOLDER, value)
         
     def set_font_ttf(self, font_file: FontFile):
-        font_file.save_to(self.font_ttf_path)
-        self.compile_reqs["font_ttf"] = True
-
-    def set_manifest(self, value: str):
-        value = sanitise_alphanum(value)
-        replace_content(
-            self.manifest_path,
-            "$$FONT_NAME$$",
-            value
-        )
-        self.compile_reqs["manifest"] = True
-
-    def set_strings(self, value: str):
-        replace_content(
-            self.strings_path,
-            "$$FONT_NAME$$",
-            value
-        )
-        self.compile_reqs["strings"] = True
+        # font_file must not be used by the caller until wait_ready
+        self._submit(("font_ttf",), font_file.save_to, self.font_ttf_path)
 
     def set_font_data(self):
-        if not self.compile_reqs["font_ttf"]:
+        if "font_ttf" not in self._pending:
             raise Exception("font_ttf needs to be set before calling set_font_data")
 
-        font_data = FontData(self.font_ttf_path)
+        self._submit(
+            ("font_data",), self._write_font_data, self._pending["font_ttf"]
+        )
+
+    def _write_font_data(self, font_ttf_future):
+        font_ttf_future.result()
+        font_data = FontData.from_raw(self.font_ttf_path)
         value = font_data.get_font_data()
 
         with open(self.font_data_path, 'wb') as fdat:
             fdat.write(value)
-            self.compile_reqs["font_data"] = True
+
+    def wait_ready(self):
+        """
+        Blocks until all queued writes are done. Re-raises the first
+        exception raised by any of them.
+        """
+        futures = set(self._pending.values())
+        wait(futures)
+        for future in futures:
+            future.result()
 
     def is_read_to_complie(self) -> bool:
         return all(self.compile_reqs.values())
 
 
-def replace_content(file_path, old_str, new_str):
-    with open(file_path, "r") as target:
-        contents = target.read()
-        if old_str not in contents:
-            logger.warning(f'replace_content: "{old_str}" not found in "{file_path}"')
+def replace_content(file_path: Path, old_str: str, new_str: str):
+    """
+    Replaces all occurrences of old_str in the file with new_str. The
+    file is read and written once, as utf-8 encoded bytes.
+
+    Args:
+        file_path (Path): The path to the file.
+        old_str (str): The placeholder to be replaced.
+        new_str (str): The replacement value.
+    """
+    file_path = Path(file_path)
+    old_bytes = old_str.encode("utf-8")
+    contents = file_path.read_bytes()
+
+    if old_bytes not in contents:
+        logger.warning(f'replace_content: "{old_str}" not found in "{file_path}"')
 
-    with open(file_path, "w") as target:
-        target.write(contents.replace(old_str, new_str))
\ No newline at end of file
+    file_path.write_bytes(contents.replace(old_bytes, new_str.encode("utf-8")))
\ No newline at end of file
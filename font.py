@@ -1,8 +1,14 @@
+import io
+import mmap
 import logging
 import struct
+from functools import cached_property
 from pathlib import Path
-from fontTools import ttLib, subset 
+from tempfile import TemporaryDirectory
+from fontTools import ttLib
+from fontTools.ttLib.tables._n_a_m_e import makeName
 
+from jar_tools import run_subp
 from utils import (
     get_ext, 
     get_basename_wo_ext, 
@@ -22,7 +28,8 @@ class FontBase:
     """
     def __init__(self, font_path: Path):
         self.path = font_path
-        self.font = ttLib.TTFont(font_path)
+        # Tables are decompiled on first access, most are never touched
+        self.font = ttLib.TTFont(font_path, lazy=True, recalcTimestamp=False)
 
     def _get_table(self, table_key):
         table = self.font.get(table_key)
@@ -32,10 +39,11 @@ class FontBase:
         return table
 
 
-class FontData(FontBase):
+class FontData:
     """
-    This class inherits from `FontBase`. It generates the font data
-    required for the final apk. 
+    Generates the font data required for the final apk, from the 
+    checkSumAdjustment of the head table and the name table. Use 
+    `from_raw` or `from_font` to read them from a font file.
     
     NOTE: Font data should only be generated after the font is saved 
     or compiled, otherwise the checkSumAdjustment in head table would 
@@ -43,50 +51,109 @@ class FontData(FontBase):
 
     Args:
         font_path (Path): The path to the font file.
+        checksum_adj (int): checkSumAdjustment from the head table.
+        name (table__n_a_m_e): The decoded name table.
     """
     MAGIC_NUM = 0x34234291
     CONSTANT_1 = 0x68796374
     CONSTANT_2 = 0x687969bb
+    SFNT_VERSIONS = (b"\x00\x01\x00\x00", b"OTTO", b"true")
 
-    def __init__(self, font_path):
-        super().__init__(font_path)
-        self.head = self._get_table("head")
-        self.name = self._get_table("name")
+    def __init__(self, font_path: Path, checksum_adj: int, name):
+        self.path = font_path
+        self.checksum_adj = checksum_adj
+        self.name = name
 
-    def get_font_data(self) -> bytes:
+    @classmethod
+    def from_font(cls, font_path: Path):
+        """
+        Alternative constructor that loads the font with `TTFont`.
+
+        Args:
+            font_path (Path): The path to the font file.
+        """
+        font = FontBase(font_path)
+        return cls(
+            font_path,
+            font._get_table("head").checkSumAdjustment,
+            font._get_table("name")
+        )
+
+    @classmethod
+    def from_raw(cls, font_path: Path):
+        """
+        Alternative constructor that skips `TTFont`. The sfnt table 
+        directory is read with struct and only checkSumAdjustment from 
+        the head table and the raw name table are extracted. The name 
+        table is still decoded by fontTools, so the best family and 
+        subfamily names are picked the same way. Falls back to the 
+        `from_font` for flavored (WOFF/WOFF2) fonts.
+
+        Args:
+            font_path (Path): The path to the font file.
+        """
+        with open(font_path, "rb") as font, \
+                mmap.mmap(font.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            sfnt_version, num_tables = struct.unpack_from(">4sH", data, 0)
+            if sfnt_version not in FontData.SFNT_VERSIONS:
+                return cls.from_font(font_path)
+
+            tables = {}
+            for i in range(num_tables):
+                tag, _, offset, length = struct.unpack_from(
+                    ">4sIII", data, 12 + i * 16
+                )
+                tables[tag] = (offset, length)
+
+            for tag in (b"head", b"name"):
+                if tag not in tables:
+                    raise Exception(f"Could not locate {tag.decode()} table in font: {font_path}")
+
+            head_offset, _ = tables[b"head"]
+            (checksum_adj,) = struct.unpack_from(">I", data, head_offset + 8)
+            name_offset, name_length = tables[b"name"]
+            name_data = data[name_offset:name_offset + name_length]
+
+        name = ttLib.newTable("name")
+        name.decompile(name_data, None)
+        return cls(font_path, checksum_adj, name)
 
-        magic_num = struct.pack('<I', 0x34234291)
+    def get_font_data(self) -> bytes:
         name_id_1 = self.name.getBestFamilyName().encode('utf-8')
-        name_id_1_len = struct.pack('<I', len(name_id_1))
         name_id_2 = self.name.getBestSubFamilyName().encode('utf-8')
-        name_id_2_len = struct.pack('<I', len(name_id_2))
-        checksum_adj = self.head.checkSumAdjustment
-        byteswapped_checksum = struct.pack('<I', checksum_adj)
-        byteswapped_checksum_plus_constant = self._uint32_le(
-            checksum_adj + FontData.CONSTANT_1
-        )
+        name_id_1_len = len(name_id_1)
+        name_id_2_len = len(name_id_2)
+        checksum_adj = self.checksum_adj
         hash_name_id_1 = self._calc_hash(name_id_1)
         hash_name_id_2 = self._calc_hash(name_id_2)
-        combined_hash = self._uint32_le(
-            hash_name_id_1 * 2 + hash_name_id_2 + FontData.CONSTANT_2
-        )
 
-        # This is the structure of font.dat:
-        output = [magic_num]
-        output.append(name_id_1_len)
-        output.append(name_id_1)
-        output.append(name_id_1_len)
-        output.append(name_id_1)
-        output.append(name_id_2_len)
-        output.append(name_id_2)
-        output.append(byteswapped_checksum)
-        output.append(byteswapped_checksum_plus_constant)
-        output.append(combined_hash)
-        output.append(name_id_1_len)
-        output.append(name_id_1)
-
-        font_data = b''.join(output)
-        return font_data
+        # This is the structure of font.dat, all ints are uint32 LE:
+        # magic num, name_id_1 len, name_id_1, name_id_1 len, name_id_1,
+        # name_id_2 len, name_id_2, checksum, checksum + constant, 
+        # combined hash, name_id_1 len, name_id_1
+        layout = (
+            f"<II{name_id_1_len}sI{name_id_1_len}sI{name_id_2_len}s"
+            f"IIII{name_id_1_len}s"
+        )
+        font_data = bytearray(struct.calcsize(layout))
+        struct.pack_into(
+            layout, 
+            font_data, 
+            0,
+            FontData.MAGIC_NUM,
+            name_id_1_len, 
+            name_id_1,
+            name_id_1_len, 
+            name_id_1,
+            name_id_2_len, 
+            name_id_2,
+            checksum_adj,
+            self._uint32(checksum_adj + FontData.CONSTANT_1),
+            self._uint32(hash_name_id_1 * 2 + hash_name_id_2 + FontData.CONSTANT_2),
+            name_id_1_len, 
+            name_id_1
+        )
+        return bytes(font_data)
     
     def _calc_hash(self, data_bytes):
         hash = 0x1505
@@ -95,8 +162,8 @@ class FontData(FontBase):
             hash = hash * 0x21 + byte
         return hash & 0xffffffff
 
-    def _uint32_le(self, data_hex):
-        return struct.pack('<I', data_hex & 0xffffffff)
+    def _uint32(self, value):
+        return value & 0xffffffff
 
 
 class FontFile(FontBase):
@@ -118,6 +185,19 @@ class FontFile(FontBase):
     PLATENC_ID = 1 # unicode bmp
     LANG_ID = 1033 # english
 
+    NAME_SEP = " - "
+
+    # Tables that LG UX doesn't use, dropped to save subsetter work
+    DROP_TABLES = [
+        "DSIG", "LTSH", "VDMX", "hdmx", "EBDT", "EBLC", "prep", "FFTM"
+    ]
+    # Kerning, shaping and vertical metrics, only dropped on request as
+    # complex scripts and CJK vertical text depend on them
+    LAYOUT_TABLES = [
+        "GSUB", "GPOS", "GDEF", "kern", "morx", "mort", "vhea", "vmtx"
+    ]
+    CACHED_NAMES = ("family", "subfamily", "combined_name")
+
     def __init__(self, font_path: Path):
         super().__init__(font_path)
 
@@ -127,46 +207,59 @@ class FontFile(FontBase):
         self.subset_options = None
 
     def sanitise_name(self):
-        family_records = self._locate_name_recs(FontFile.FAMILY_ID)
-        subfamily_records = self._locate_name_recs(FontFile.SUBFAM_ID)
-        self._setName(family_records, FontFile.FAMILY_ID)
-        self._setName(subfamily_records, FontFile.SUBFAM_ID)
+        name_ids = (FontFile.FAMILY_ID, FontFile.SUBFAM_ID)
+        found_ids = set()
+
+        # Records are updated in place, setName would rescan the table
+        # for every record
+        for record in self.name.names:
+            if record.nameID in name_ids:
+                self._rename_record(record)
+                found_ids.add(record.nameID)
+
+        for name_id in name_ids:
+            if name_id not in found_ids:
+                self._add_name_record(name_id)
 
-    def _locate_name_recs(self, name_id):
-        return [rec for rec in self.name.names if rec.nameID == name_id]
+        self._reset_names()
+
+    def _rename_record(self, record):
+        old_name = str(record)
+        sanitised_font_name = sanitise_alphanum(old_name, to_ignore=" ")
+        cropped_font_name = sanitised_font_name[:FontFile.MAX_CHARS]
+        logger.debug(f"Changing {old_name} => {cropped_font_name} for NameRecord: ({record.nameID}, {record.platformID}, {record.platEncID}, {record.langID})")
+        record.string = cropped_font_name
+
+    def _add_name_record(self, id):
+        cropped_file_name = self._cropped_file_name
+        logger.debug(f"Setting NameID {id} to: {cropped_file_name}")
+        self.name.names.append(makeName(
+            cropped_file_name, 
+            id, 
+            FontFile.PLATFORM_ID, 
+            FontFile.PLATENC_ID, 
+            FontFile.LANG_ID
+        ))
     
-    def _setName(self, records, id):
-        if len(records) == 0:
-            sanitised_file_name = sanitise_alphanum(
-                self.font_file_name, to_ignore=" "
-            )
-            cropped_file_name = sanitised_file_name[:FontFile.MAX_CHARS]
-            logger.debug(f"Setting NameID {id} to: {cropped_file_name}")
-            self.name.setName(
-                cropped_file_name, 
-                id, 
-                FontFile.PLATFORM_ID, 
-                FontFile.PLATENC_ID, 
-                FontFile.LANG_ID
-            )
+    def subset_font(self, drop_layout=False, hb_subset_path=None):
+        drop_tables = list(FontFile.DROP_TABLES)
+        if drop_layout:
+            drop_tables += FontFile.LAYOUT_TABLES
+
+        if hb_subset_path:
+            self._hb_subset_font(hb_subset_path, drop_tables, drop_layout)
         else:
-            for old_record in records:
-                old_name = str(old_record)
-                sanitised_font_name = sanitise_alphanum(old_name, to_ignore=" ")
-                cropped_font_name = sanitised_font_name[:FontFile.MAX_CHARS]
-                logger.debug(f"Changing {old_name} => {cropped_font_name} for NameRecord: ({old_record.nameID}, {old_record.platformID}, {old_record.platEncID}, {old_record.langID})")
-                self.name.setName(
-                    cropped_font_name, 
-                    old_record.nameID, 
-                    old_record.platformID, 
-                    old_record.platEncID, 
-                    old_record.langID
-                )
-    
-    def subset_font(self):
+            self._fonttools_subset_font(drop_tables, drop_layout)
+        self._reset_names()
+
+    def _fonttools_subset_font(self, drop_tables, drop_layout):
+        # Imported here, fontTools.subset is slow to import and isn't
+        # needed when hb-subset is used
+        from fontTools import subset
+
         self.subset_options = subset.Options()
-        self.subset_options.layout_features = ["*"]
-        self.subset_options.no_subset_tables += ["FFTM"]
+        self.subset_options.layout_features = [] if drop_layout else ["*"]
+        self.subset_options.drop_tables += drop_tables
         self.subset_options.hinting = False
 
         subsetter = subset.Subsetter(options=self.subset_options)
@@ -175,37 +268,112 @@ class FontFile(FontBase):
         )
         subsetter.subset(self.font)
 
-    def _character_set(self) -> list:
-        unicodes = []
+    def _hb_subset_font(self, hb_subset_path, drop_tables, drop_layout):
+        # Same options as _fonttools_subset_font: all glyphs are kept, 
+        # hinting and drop_tables are dropped. hb-subset can't subset SVG
+        # and drops it by default, fontTools keeps it. With every glyph id
+        # retained SVG (and other unknown tables) can be passed through.
+        with TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir)
+            input_path = tmp_dir / "input.ttf"
+            output_path = tmp_dir / "output.ttf"
+            unicodes_path = tmp_dir / "unicodes.txt"
+
+            self.font.flavor = None
+            self.font.save(input_path)
+            unicodes_path.write_text(
+                ",".join(_unicode_ranges(self._character_set()))
+            )
+            glyph_count = len(self.font.getGlyphOrder())
+
+            command = [
+                hb_subset_path,
+                input_path,
+                f"--unicodes-file={unicodes_path}",
+                f"--gids=0-{glyph_count - 1}",
+                "--no-hinting",
+                "--retain-gids",
+                "--passthrough-tables",
+                f"--drop-tables+={','.join(drop_tables)}",
+                "--drop-tables-=SVG",
+                f"--output-file={output_path}",
+            ]
+            if not drop_layout:
+                command.append("--layout-features=*")
+
+            run_subp(command)
+
+            font_bytes = io.BytesIO(output_path.read_bytes())
+
+        # Not lazy, TTFont.save expects a lazy font's reader to be a named file
+        self.font = ttLib.TTFont(font_bytes, recalcTimestamp=False)
+        self.name = self._get_table("name")
+
+    def _character_set(self) -> set:
+        unicodes = set()
         for t in self.font["cmap"].tables:
             if t.isUnicode():
-                unicodes.extend(t.cmap.keys())
+                unicodes.update(t.cmap.keys())
         return unicodes
     
     def save_to(self, save_path):
         if not self.subset_options:
+            # font.ttf has to be a plain sfnt, same as subset.save_font
+            self.font.flavor = None
             self.font.save(save_path)
         else:
+            from fontTools import subset
             subset.save_font(self.font, save_path, self.subset_options)
 
+    @cached_property
+    def _sanitised_file_name(self):
+        return sanitise_alphanum(self.font_file_name, to_ignore=" ")
+
+    @cached_property
+    def _cropped_file_name(self):
+        return self._sanitised_file_name[:FontFile.MAX_CHARS]
+
     def _get_name(self, from_font):
         logger.debug(f"_get_name: {from_font = }")
-        sanitised_file_name = sanitise_alphanum(
-            self.font_file_name, to_ignore=" "
-        )
-        return from_font if from_font is not None else sanitised_file_name
+        return from_font if from_font is not None else self._sanitised_file_name
+
+    def _reset_names(self):
+        # The name table changed, drop the cached lookups
+        for attr in FontFile.CACHED_NAMES:
+            self.__dict__.pop(attr, None)
 
-    def get_family(self):
+    @cached_property
+    def family(self):
         return self._get_name(self.name.getBestFamilyName())
 
-    def get_subfamily(self):
+    @cached_property
+    def subfamily(self):
         return self._get_name(self.name.getBestSubFamilyName())
     
-    def get_combined_name(self, sep=""):
-        family = self.get_family()
-        subfam = self.get_subfamily()
-
-        if family == subfam:
-            return family
+    @cached_property
+    def combined_name(self):
+        if self.family == self.subfamily:
+            return self.family
         
-        return family + sep + subfam
\ No newline at end of file
+        return self.family + FontFile.NAME_SEP + self.subfamily
+
+
+def _unicode_ranges(unicodes) -> list:
+    """
+    Collapses code points into hex ranges, e.g. {0x41, 0x42, 0x43, 0x61}
+    becomes ["41-43", "61"]. This is the format hb-subset expects.
+    """
+    ranges = []
+    start = end = None
+
+    for code in sorted(unicodes):
+        if end is not None and code == end + 1:
+            end = code
+            continue
+        if start is not None:
+            ranges.append(f"{start:X}" if start == end else f"{start:X}-{end:X}")
+        start = end = code
+
+    if start is not None:
+        ranges.append(f"{start:X}" if start == end else f"{start:X}-{end:X}")
+    return ranges
\ No newline at end of file
@@ -1,19 +1,27 @@
 import re
 import logging
+import threading
 import subprocess
 from pathlib import Path
+from collections import deque
 
 
 logger = logging.getLogger(__name__)
 
 JAVA_PATH = "java" 
+# apktool and uber-apk-signer are short lived, so the JVM is tuned for
+# startup time: C1 only JIT and serial GC.
+JAVA_OPTS = ["-XX:TieredStopAtLevel=1", "-XX:+UseSerialGC"]
+STDERR_TAIL_LINES = 50
+
+_SHELL_SPLIT_RE = re.compile(r'"[^"]*"|[^"\s]\S*')
 
 
 def java_check():
     """
     Checks for java by running `java --version`
     """
-    command = JAVA_PATH + " --version"
+    command = [JAVA_PATH, "--version"]
     try:
         run_subp(command)
     except FileNotFoundError as e:
@@ -22,24 +30,47 @@ def java_check():
 
 def run_subp(command, shell=False, cwd=None, log_output=True):
     """
-    Run commands using subprocess.run
+    Run commands using subprocess.Popen. Output is streamed line by line
+    instead of being buffered until the process exits, only the last
+    `STDERR_TAIL_LINES` lines of stderr are kept for the error message.
 
     Args:
-        command (str): Command to be executed.
+        command (str | list): Command to be executed. A string is split
+            with `shell_split` unless shell is used, a list is passed on
+            as is.
         shell (bool): To use shell or not.
         cwd (str): Work directory.
         log_output (bool): Logs output at debug level.
     """
-    if not shell:
+    if not shell and isinstance(command, str):
         command = shell_split(command)
     
     logger.debug(f"Running command: {command}")
-    output = subprocess.run(command, capture_output=True, shell=shell, cwd=cwd)
-
-    if output.returncode != 0:
-        raise Exception(output.stderr.decode(errors="ignore"))
-    elif output.stdout and log_output:
-        logger.debug(output.stdout.decode(errors="ignore"))
+    with subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        shell=shell,
+        cwd=cwd,
+        text=True,
+        errors="ignore",
+        bufsize=1
+    ) as proc:
+        stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+        stderr_reader = threading.Thread(
+            target=stderr_tail.extend, args=(proc.stderr,), daemon=True
+        )
+        stderr_reader.start()
+
+        for line in proc.stdout:
+            if log_output:
+                logger.debug(line.rstrip())
+
+        stderr_reader.join()
+        returncode = proc.wait()
+
+    if returncode != 0:
+        raise Exception("".join(stderr_tail))
 
 
 class JarHandler:
@@ -54,12 +85,12 @@ class JarHandler:
         validate_file(jar_path, "*.jar")
 
         self.path = jar_path
-        self.command = f'{JAVA_PATH} -jar "{jar_path}"'
+        self.command = [JAVA_PATH, *JAVA_OPTS, "-jar", str(jar_path)]
 
-    def run(self, args, shell=False, cwd=None, log_output=True):
-        full_command = f"{self.command} {args}"
+    def run(self, args: list, cwd=None, log_output=True):
+        full_command = self.command + [str(arg) for arg in args]
 
-        run_subp(full_command, shell, cwd, log_output)
+        run_subp(full_command, cwd=cwd, log_output=log_output)
 
 
 def validate_file(file_path: Path, pattern: str):
@@ -80,8 +111,7 @@ def shell_split(command: str) -> list:
     Returns:
         list: Command split into individual portions
     """
-    pattern = r'"[^"]*"|[^"\s]\S*'
-    matches = re.findall(pattern, command)
+    matches = _SHELL_SPLIT_RE.findall(command)
     return [match.strip('"') for match in matches]
 
 
@@ -103,7 +133,7 @@ class APKToolJar(JarHandler):
         if apk_dir.is_file():
             raise Exception(f"Given apk_dir is a file, needs to be a directory: {apk_dir}")
 
-        self.run(f'b {apk_dir} -o "{output_path}"', cwd=work_dir)
+        self.run(["b", apk_dir, "-o", output_path], cwd=work_dir)
 
 
 class APKSignerJar(JarHandler):
@@ -122,5 +152,10 @@ class APKSignerJar(JarHandler):
         super().__init__(jar_path)
 
     def sign(self, apk_path, work_dir):
-        validate_file(apk_path, "*.apk")
-        self.run(f'--overwrite -a "{apk_path}"', cwd=work_dir)
\ No newline at end of file
+        """
+        Signs the apk in place. apk_path can also be a directory, every
+        apk in it is then signed by a single uber-apk-signer run.
+        """
+        if not apk_path.is_dir():
+            validate_file(apk_path, "*.apk")
+        self.run(["--overwrite", "-a", apk_path], cwd=work_dir)
\ No newline at end of file
@@ -1,14 +1,19 @@
+import os
 import logging
 import argparse
 from pathlib import Path
+from tempfile import TemporaryDirectory
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from font import FontFile
-from build_files import BuildContext, FontAPK
+from build_files import BuildContext, FontAPK, can_hardlink, snapshot_apk_dir
 from jar_tools import APKToolJar, APKSignerJar, java_check
 from utils import (
     files_to_process,
     output_path_validator,
-    gen_unique_apk_path
+    gen_unique_apk_path,
+    get_basename_wo_ext,
+    hb_subset_validator
 )
 
 
@@ -44,10 +49,78 @@ args_help = {
     "output": """Output directory, the generated apk files
                 should appear here. The apk files will have 
                 the same name as the font file. This cannot 
-                be a file path."""
+                be a file path.""",
+    "jobs": """Number of fonts to process in parallel.
+                Defaults to the number of CPUs.""",
+    "skip_subset": """Skip subsetting, the font is only renamed
+                and packaged. Faster, but hinting is kept.""",
+    "drop_layout": """Drop OpenType layout and vertical metrics
+                tables (GSUB, GPOS, GDEF, kern, morx, mort,
+                vhea, vmtx) when subsetting. Faster and smaller,
+                but loses kerning, breaks shaping for complex
+                scripts (e.g. Arabic, Indic) and vertical CJK
+                text.""",
+    "hb_subset": """Subset with HarfBuzz's hb-subset instead of
+                fontTools, usually a lot faster for large
+                fonts. The executable is taken from the 
+                HB_SUBSET_PATH environment variable, or 
+                hb-subset on PATH."""
 }
 
 
+def process_font(
+    count_str, 
+    font_path, 
+    apk_path, 
+    output_path, 
+    build_files, 
+    apk_snapshot, 
+    skip_subset, 
+    drop_layout, 
+    hb_subset_path
+):
+    """
+    Generates the unsigned apk for a single font file, the apks are 
+    signed together by `main`. Runs in a worker process, so everything 
+    it needs is passed in as picklable args.
+
+    Args:
+        count_str (str): Progress prefix used for logging.
+        font_path (Path): The path to the font file.
+        apk_path (Path): Output path of the unsigned apk.
+        output_path (Path): Work dir for apktool.
+        build_files (Path): The path to the build files.
+        apk_snapshot (bytes): Tar archive of the apk dir, None if the
+            apk files can be hardlinked.
+        skip_subset (bool): Don't run the font through the subsetter.
+        drop_layout (bool): Drop the layout tables when subsetting.
+        hb_subset_path (str): hb-subset executable, fontTools is used
+            if None.
+    """
+    logger.info(f"Processing font {count_str}: {font_path}")
+    font_file = FontFile(font_path)
+    font_file.sanitise_name()
+    if not skip_subset:
+        backend = hb_subset_path or "fontTools"
+        logger.info(f"{count_str} Subsetting with {backend}")
+        font_file.subset_font(drop_layout, hb_subset_path)
+
+    with BuildContext(build_files, apk_snapshot) as bc:
+        logger.info(f"{count_str} Setting files and values")
+        # Names are read before font_file is handed to the writer thread
+        full_name = font_file.combined_name
+
+        with FontAPK(bc.apk_dir) as font_apk:
+            font_apk.set_font_ttf(font_file)
+            font_apk.set_font_data()
+            font_apk.apply_font_name(full_name)
+            font_apk.wait_ready()
+
+        logger.info(f"{count_str} Building apk")
+        apktool = APKToolJar(bc.apktool_path.absolute())
+        apktool.build(bc.apk_dir, apk_path, output_path)
+
+
 def main():
     parser = argparse.ArgumentParser(description='LG Font Gen')
     parser.add_argument(
@@ -61,10 +134,38 @@ def main():
         type=files_to_process, 
         help=args_help['input']
     )
+    parser.add_argument(
+        '-j', 
+        '--jobs', 
+        type=int, 
+        default=os.cpu_count(), 
+        help=args_help['jobs']
+    )
+    parser.add_argument(
+        '--skip-subset', 
+        action='store_true', 
+        help=args_help['skip_subset']
+    )
+    parser.add_argument(
+        '--drop-layout', 
+        action='store_true', 
+        help=args_help['drop_layout']
+    )
+    parser.add_argument(
+        '--hb-subset', 
+        action='store_true', 
+        help=args_help['hb_subset']
+    )
     args = parser.parse_args()
 
     java_check()
 
+    hb_subset_path = None
+    if args.hb_subset:
+        hb_subset_path = hb_subset_validator(
+            os.environ.get("HB_SUBSET_PATH", "hb-subset")
+        )
+
     files = args.input_path
     output_path = args.output if args.output != None else Path().absolute()
 
@@ -74,37 +175,81 @@ def main():
     file_count = len(files)
     logger.info(f"Found {len(files)} compatible font files: {files}")
 
-    for count, font_path in enumerate(files, start=1):
-        count_str = f"[{count}/{file_count}]"
-        logger.info(f"Processing font {count_str}: {font_path}")
-        font_file = FontFile(font_path)
-        font_file.sanitise_name()
-        font_file.subset_font()
-
-        logger.info("Preparing build files")
-        build_files = Path("apk_build_files")
-        
-        with BuildContext(build_files) as bc:
-            logger.info("Setting files and values")
-            font_apk = FontAPK(bc.apk_dir)
-            font_apk.set_font_ttf(font_file)
-            font_apk.set_font_data()
+    logger.info("Preparing build files")
+    build_files = Path("apk_build_files")
+    # Tested once here, a failing link per font would be wasted work
+    apk_snapshot = None
+    if not can_hardlink(build_files):
+        logger.info("Hardlinks not supported for temp dir, using snapshot")
+        apk_snapshot = snapshot_apk_dir(build_files)
+
+    count_strs = [f"[{count}/{file_count}]" for count in range(1, file_count + 1)]
+
+    # Picked up front, workers checking for existing apks would race
+    apk_paths = []
+    reserved = set()
+    for font_path in files:
+        apk_path = gen_unique_apk_path(
+            get_basename_wo_ext(font_path), output_path, reserved
+        )
+        apk_paths.append(apk_path)
+        reserved.add(apk_path)
+
+    max_workers = max(1, min(args.jobs or 1, file_count))
+
+    failed_fonts = []
+    # Apks are built into a staging dir and signed with a single 
+    # uber-apk-signer run, instead of starting a signer JVM per font. 
+    # It's inside the output dir so the signed apks can be renamed out.
+    with TemporaryDirectory(dir=output_path, prefix=".lgfontgen-") as staging_dir:
+        staging_dir = Path(staging_dir)
+        built_apks = {}
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for count_str, font_path, apk_path in zip(count_strs, files, apk_paths):
+                staged_path = staging_dir / apk_path.name
+                future = executor.submit(
+                    process_font,
+                    count_str,
+                    font_path,
+                    staged_path,
+                    staging_dir,
+                    build_files,
+                    apk_snapshot,
+                    args.skip_subset,
+                    args.drop_layout,
+                    hb_subset_path
+                )
+                futures[future] = (count_str, font_path, staged_path, apk_path)
 
-            full_name = font_file.get_combined_name(sep=" - ")
-            font_apk.set_font_xml(full_name)
-            font_apk.set_manifest(full_name)
-            font_apk.set_strings(full_name)
+            # Keep going on failure, the other fonts are independent
+            for future in as_completed(futures):
+                count_str, font_path, staged_path, apk_path = futures[future]
+                try:
+                    future.result()
+                    built_apks[staged_path] = (count_str, apk_path)
+                except Exception as e:
+                    logger.error(f"{count_str} Failed {font_path}: {e}")
+                    failed_fonts.append(font_path)
+                    # Don't let a partial apk reach the signer
+                    staged_path.unlink(missing_ok=True)
 
-            logger.info("Building apk")
-            apktool = APKToolJar(bc.apktool_path.absolute())
-            apk_path = gen_unique_apk_path(font_file.font_file_name, output_path)
-            apktool.build(bc.apk_dir, apk_path, output_path)
+        if built_apks:
+            logger.info(f"Signing {len(built_apks)} apks")
+            apksigner_path = build_files / BuildContext.APKSIGNER_JAR
+            apksigner = APKSignerJar(apksigner_path.absolute())
+            apksigner.sign(staging_dir, staging_dir)
 
-            logger.info("Signing apk")
-            apksigner = APKSignerJar(bc.apksigner_path.absolute())
-            apksigner.sign(apk_path, output_path)
-            logger.info(f"Saved apk to: {apk_path}")
+            for staged_path, (count_str, apk_path) in built_apks.items():
+                os.replace(staged_path, apk_path)
+                logger.info(f"{count_str} Saved apk to: {apk_path}")
 
+    if failed_fonts:
+        raise Exception(
+            f"Failed to generate {len(failed_fonts)} of {file_count} apks: "
+            f"{[str(p) for p in failed_fonts]}"
+        )
 
 if __name__ == '__main__':
     try:
@@ -1,7 +1,15 @@
+import os
+import re
+import shutil
+from functools import lru_cache
 from pathlib import Path
 from datetime import datetime
 
 
+FONT_EXTS = frozenset({".ttf", ".otf", ".woff", ".woff2"})
+
+
+@lru_cache(maxsize=1024)
 def sanitise_alphanum(name: str, to_ignore = "") -> str:
     """
     Sanitise a string by removing non-alphanumeric characters.
@@ -13,7 +21,16 @@ def sanitise_alphanum(name: str, to_ignore = "") -> str:
     Returns:
         str: The sanitised string containing only alphanumeric characters.
     """
-    return ''.join(char for char in name if char.isalnum() or char in to_ignore)
+    return _non_alphanum_pattern(to_ignore).sub("", name)
+
+
+@lru_cache(maxsize=None)
+def _non_alphanum_pattern(to_ignore: str) -> re.Pattern:
+    # Unicode \w is the same set as str.isalnum plus "_"
+    keep = re.escape(to_ignore)
+    if "_" in to_ignore:
+        return re.compile(rf"[^\w{keep}]")
+    return re.compile(rf"[^\w{keep}]|_")
 
 
 def get_ext(path: Path) -> str:
@@ -45,13 +62,10 @@ def get_basename_wo_ext(path: Path) -> str:
         'example'
         >>> get_basename_wo_ext(Path("image.jpg"))
         'image'
-
-    Helpers:
-        get_ext
+        >>> get_basename_wo_ext(Path("myttf.TTF"))
+        'myttf'
     """
-    file_ext = get_ext(path)
-    file_name = path.name.replace(f".{file_ext}", "")
-    return file_name
+    return path.stem
 
 
 def output_path_validator(output: str) -> Path:
@@ -80,6 +94,25 @@ def output_path_validator(output: str) -> Path:
     return output_path
 
 
+def hb_subset_validator(hb_subset: str) -> str:
+    """
+    Check if the given hb-subset executable can be found.
+
+    Args:
+        hb_subset (str): Name or path of the hb-subset executable.
+
+    Returns:
+        str: Full path to the executable.
+
+    """
+    hb_subset_path = shutil.which(hb_subset)
+
+    if hb_subset_path is None:
+        raise Exception(f"hb-subset executable not found: {hb_subset}")
+    
+    return hb_subset_path
+
+
 def valid_font(path: Path) -> bool:
     """
     Check if the given path extension matches supported font types.
@@ -92,8 +125,7 @@ def valid_font(path: Path) -> bool:
         bool: Does the file path match any of the supported file type?
 
     """
-    patterns = ["*.ttf", "*.otf", "*.woff", "*.woff2"]
-    return any([path.match(p) for p in patterns])
+    return path.suffix.lower() in FONT_EXTS
 
 
 def files_to_process(input_path: str) -> list:
@@ -121,30 +153,47 @@ def files_to_process(input_path: str) -> list:
             raise Exception(f"Input path {str(input_path)} is not a compatible file")
 
     if input_path.is_dir():
-        input_files = [p for p in input_path.iterdir() if valid_font(p)]
+        with os.scandir(input_path) as entries:
+            input_files = [
+                Path(entry.path) for entry in entries 
+                if entry.is_file() and valid_font(Path(entry.path))
+            ]
 
         if len(input_files) == 0:
             raise Exception(f"Input path {str(input_path)} does not contain any compatible files")
         return input_files
 
 
-def gen_unique_apk_path(font_file_name: str, output_dir: Path) -> Path:
+def gen_unique_apk_path(
+    font_file_name: str, output_dir: Path, reserved: set = frozenset()
+) -> Path:
     """
     Generates the output apk name. Uses the same name as the font file.
-    Adds a timestamp if there already exists an apk file with the same name. 
+    Adds a timestamp if there already exists an apk file with the same name
+    or the name is reserved for another font, plus a counter if that is 
+    taken as well. 
 
     Args:
         font_file_name (str): The font file name w/o the extension.
+        output_dir (Path): Output directory for the apk.
+        reserved (set): Paths already picked for other fonts in this run.
 
     Returns:
         Path: Output path plus the unique apk name.
 
     """
-    suffix = ".apk"
-    possible_path = output_dir / (font_file_name + suffix)
-
-    if possible_path.exists():
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        suffix = f"_{timestamp}.apk"
+    def is_taken(path):
+        return path.exists() or path in reserved
+
+    possible_path = output_dir / (font_file_name + ".apk")
+    if not is_taken(possible_path):
+        return possible_path
+
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    possible_path = output_dir / f"{font_file_name}_{timestamp}.apk"
+    count = 1
+    while is_taken(possible_path):
+        possible_path = output_dir / f"{font_file_name}_{timestamp}_{count}.apk"
+        count += 1
     
-    return output_dir / (font_file_name + suffix)
\ No newline at end of file
+    return possible_path
\ No newline at end of file